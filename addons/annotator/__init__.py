@@ -70,7 +70,7 @@ class SelectAnnotationLayer(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        tool = bpy.context.workspace.tools.from_space_view3d_mode(bpy.context.mode, create=False).idname
+        tool = context.workspace.tools.from_space_view3d_mode(context.mode, create=False).idname
         return "annotate" in tool
 
 
@@ -99,7 +99,7 @@ class RemoveAnnotation(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        tool = bpy.context.workspace.tools.from_space_view3d_mode(bpy.context.mode, create=False).idname
+        tool = context.workspace.tools.from_space_view3d_mode(context.mode, create=False).idname
         return "annotate" in tool
 
 
@@ -23,13 +23,22 @@ bl_info = {
 }
 
 import bpy
-import mathutils
 from mathutils.kdtree import KDTree
 import re
-import math
-from typing import Union, Tuple, List, Callable, Any
+import numpy as np
+from typing import Union, Tuple, List, Dict, Callable, Any
 from functools import reduce
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba isn't bundled with Blender. Without it, the jitted functions run as plain Python
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+    prange = range
+
 from bpy.props import (StringProperty,
                        BoolProperty,
                        IntProperty,
@@ -44,16 +53,21 @@ from bpy.types import (Panel,
                        PropertyGroup,
                        )
 
+_DAZ_BONE_RE = re.compile(r"^(l|r)([A-Z]+.*)$")
+_RIGHT_BONE_RE = re.compile(r"^(.+)_L$")
+_KEY_BLOCK_RE = re.compile(r'key_blocks\["(.+)"\]')
+
 
 # ------------------------------------------------------------------------
 #   Utilities
 # ------------------------------------------------------------------------
 
 def move_modifier(obj, source, target, after=False, default_index=0):
-    target_index = obj.modifiers.find(target)
+    indices = {m.name: i for i, m in enumerate(obj.modifiers)}
+    target_index = indices.get(target, -1)
     move_func = bpy.ops.object.modifier_move_to_index
     if target_index != -1:
-        source_index = obj.modifiers.find(source)
+        source_index = indices.get(source, -1)
         if source_index != -1:
             if source_index < target_index:
                 if after:
@@ -69,6 +83,15 @@ def move_modifier(obj, source, target, after=False, default_index=0):
         move_func(modifier=source, index=default_index)
 
 
+def world_vertices(obj: bpy.types.Object, mesh: bpy.types.Mesh) -> np.ndarray:
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    m = np.array(obj.matrix_world, dtype=np.float32)
+    world_co = co.reshape(-1, 3) @ m[:3, :3].T
+    world_co += m[:3, 3]
+    return world_co
+
+
 def active_and_others(ctx: bpy.types.Context) -> Union[Tuple[bpy.types.Object, List[bpy.types.Object]]]:
     active = ctx.active_object
     selected = ctx.selected_objects
@@ -96,11 +119,17 @@ def selected_one_or_more(ctx: bpy.types.Context, type: str) -> bool:
     
 
 def for_each_selected(ctx: bpy.types.Context,
-                      execute: Callable[[bpy.types.Object], Any]):
+                      execute: Callable[[bpy.types.Object], Any],
+                      set_active: bool = True):
     objs = ctx.selected_objects
     for obj in objs:
-        ctx.view_layer.objects.active = obj
-        execute(obj)
+        if set_active or not hasattr(ctx, "temp_override"):
+            ctx.view_layer.objects.active = obj
+            execute(obj)
+        else:
+            # Blender 3.2+: override the context without changing the real active object
+            with ctx.temp_override(active_object=obj, object=obj, selected_objects=[obj]):
+                execute(obj)
     
 
 
@@ -118,9 +147,9 @@ class CopyCustomShapes(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        selected =  bpy.context.selected_objects
-        source =  bpy.context.active_object
-        
+        selected = context.selected_objects
+        source = context.active_object
+
         if (source is None
                 or source.type != 'ARMATURE'
                 or len(selected) <= 1):
@@ -133,18 +162,17 @@ class CopyCustomShapes(bpy.types.Operator):
 
 
     def execute(self, context):
-        def copy_custom_shapes(source: bpy.types.Pose, target: bpy.types.Pose):
-            for source_bone in source.bones:
-                target_bone = target.bones.get(source_bone.name)
-                if target_bone:
-                    target_bone.custom_shape = source_bone.custom_shape
-        
-        selected =  bpy.context.selected_objects
-        source =  bpy.context.active_object
+        selected = context.selected_objects
+        source = context.active_object
+        if not source.pose:
+            return {'CANCELLED'}
 
+        custom_shapes = {b.name: b.custom_shape for b in source.pose.bones}
         for target in selected:
-            if target is not source and source.pose and target.pose:
-                copy_custom_shapes(source.pose, target.pose) 
+            if target is not source and target.pose:
+                for target_bone in target.pose.bones:
+                    if target_bone.name in custom_shapes:
+                        target_bone.custom_shape = custom_shapes[target_bone.name]
 
         return {'FINISHED'}
 
@@ -170,10 +198,11 @@ class CopyCustomProperties(bpy.types.Operator):
     def execute(self, context):
         source, targets = active_and_others(context)
 
-        props = source["_RNA_UI"]
+        keys = list(source["_RNA_UI"].keys())
+        values = [source[k] for k in keys]
         for t in targets:
-            for p in props.keys():
-                t[p] = source[p]
+            for k, v in zip(keys, values):
+                t[k] = v
 
         bpy.context.view_layer.update()
 
@@ -194,15 +223,7 @@ class RenameDazBones(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        selected = bpy.context.selected_objects
-
-        if len(selected) == 0:
-            return False
-        for obj in selected:
-            if obj.type != 'ARMATURE':
-                return False
-
-        return True
+        return selected_one_or_more(context, 'ARMATURE')
 
 
     def execute(self, context):
@@ -211,10 +232,17 @@ class RenameDazBones(bpy.types.Operator):
 
         selected =  bpy.context.selected_objects
 
+        # Work out every new name before renaming anything,
+        # renaming a bone rehashes the collection being iterated
+        renames = []
         for obj in selected:
-            for bone in obj.pose.bones:
-                p = re.compile(r"^(l|r)([A-Z]+.*)$")
-                bone.name = p.sub(repl, bone.name)
+            for bone in list(obj.pose.bones):
+                new_name = _DAZ_BONE_RE.sub(repl, bone.name)
+                if new_name != bone.name:
+                    renames.append((bone, new_name))
+
+        for bone, new_name in renames:
+            bone.name = new_name
 
         return {'FINISHED'}
 
@@ -237,15 +265,7 @@ class SymmetrizeIKConstraints(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        selected = bpy.context.selected_objects
-
-        if len(selected) == 0:
-            return False
-        for obj in selected:
-            if obj.type != 'ARMATURE':
-                return False
-
-        return True
+        return selected_one_or_more(context, 'ARMATURE')
 
 
     def execute(self, context):
@@ -258,8 +278,7 @@ class SymmetrizeIKConstraints(bpy.types.Operator):
             rb.ik_max_z = -lb.ik_min_z
 
         def get_right_bone_name(lbname):
-            p = re.compile(r"^(.+)_L$")
-            match = p.match(lbname)
+            match = _RIGHT_BONE_RE.match(lbname)
             if match:
                 return f"{match.group(1)}_R"
             else:
@@ -298,15 +317,7 @@ class ClearBoneTransforms(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        selected = bpy.context.selected_objects
-
-        if len(selected) == 0:
-            return False
-        for obj in selected:
-            if obj.type != 'ARMATURE':
-                return False
-
-        return True
+        return selected_one_or_more(context, 'ARMATURE')
 
 
     def execute(self, context):
@@ -318,8 +329,19 @@ class ClearBoneTransforms(bpy.types.Operator):
         selected =  bpy.context.selected_objects
 
         for obj in selected:
-            for b in obj.pose.bones:
-                clear(b)
+            bones = obj.pose.bones
+            n = len(bones)
+            try:
+                bones.foreach_set("location", np.zeros(3 * n, dtype=np.float32))
+                bones.foreach_set("rotation_quaternion", np.tile(np.array([1, 0, 0, 0], dtype=np.float32), n))
+                bones.foreach_set("scale", np.ones(3 * n, dtype=np.float32))
+            except (AttributeError, TypeError):
+                # Bulk access not supported by this Blender version
+                for b in bones:
+                    clear(b)
+            else:
+                # foreach_set skips the RNA updates, tag the pose for re-evaluation ourselves
+                obj.update_tag()
 
         return {'FINISHED'}
             
@@ -327,6 +349,35 @@ class ClearBoneTransforms(bpy.types.Operator):
 #   Reposition Bones
 # ------------------------------------------------------------------------
 
+def _unpack_nearest(found) -> Tuple[np.ndarray, np.ndarray]:
+    idx = np.empty(len(found), dtype=np.int64)
+    dist = np.empty(len(found), dtype=np.float32)
+    for k, (_, i, d) in enumerate(found):
+        idx[k] = i
+        dist[k] = d
+    return idx, dist
+
+
+@njit(cache=True, fastmath=True)
+def _accumulate(co, idx, dist, delta):
+    total_weight = 0.0
+    total_delta = np.zeros(3)
+    for k in range(idx.shape[0]):
+        # don't give close vertices too much weight
+        w = 1e4 if dist[k] < 1e-12 else 1.0 / dist[k]
+        total_weight += w
+        total_delta += delta[idx[k]] * w
+    return co + total_delta / total_weight
+
+
+@njit(cache=True, parallel=True)
+def _accumulate_batch(coords, idxs, dists, delta):
+    new_coords = np.empty_like(coords)
+    for i in prange(coords.shape[0]):
+        new_coords[i] = _accumulate(coords[i], idxs[i], dists[i], delta)
+    return new_coords
+
+
 class RepositionBones(bpy.types.Operator):
     bl_idname = "bony.reposition_bones"
     bl_label = "Reposition Bones"
@@ -347,48 +398,38 @@ class RepositionBones(bpy.types.Operator):
 
 
     def execute(self, context):
-        def calculate_new_co(co, group_size, evaluated_vertices, raw_vertices, kd):
-            total_weight = 0
-            total_delta = mathutils.Vector() 
-            for (vc, i, dist) in kd.find_n(co, group_size):
-                ev = evaluated_vertices[i]
-                rv = raw_vertices[i]
-                weight = (
-                    1e4 if math.isclose(dist, 0) # don't give close vertices too much weight
-                    else 1 / dist
-                )
-                total_weight += weight
-                total_delta += (ev - rv) * weight
-            
-            return co + total_delta / total_weight
-
-
         armature, others = active_and_others(context)
         obj = others[0]
         mesh = obj.data
 
         # Generative modifier like subsurf changes vertices 
-        if any([m.show_viewport and m.type != 'ARMATURE' for m in obj.modifiers]):
+        if any(m.show_viewport and m.type != 'ARMATURE' for m in obj.modifiers):
             self.report({'ERROR'}, "Please turn off the modifiers first.")
             return {'CANCELLED'}
 
 
-        raw_vertices = []
-        kd = KDTree(len(mesh.vertices))
-        for i, v in enumerate(mesh.vertices):
-            wv = obj.matrix_world @ v.co
+        raw_vertices = world_vertices(obj, mesh)
+        kd = KDTree(len(raw_vertices))
+        for i, wv in enumerate(raw_vertices):
             kd.insert(wv, i)
-            raw_vertices.append(wv)
         kd.balance()
 
         # vertices deformed by shape keys
         evaluated_obj = obj.evaluated_get(bpy.context.evaluated_depsgraph_get())
-        evaluated_mesh = evaluated_obj.to_mesh()
-        evaluated_vertices = [evaluated_obj.matrix_world @ v.co for v in evaluated_mesh.vertices]
+        try:
+            evaluated_mesh = evaluated_obj.to_mesh()
+            # How far each vertex is moved by shape keys
+            delta = world_vertices(evaluated_obj, evaluated_mesh) - raw_vertices
+        finally:
+            evaluated_obj.to_mesh_clear()
 
         bpy.ops.object.mode_set(mode='EDIT')
 
-        for eb in armature.data.edit_bones:
+        m = armature.matrix_world.copy()
+        m_inv = np.array(m.inverted())
+        edit_bones = armature.data.edit_bones
+        coords = np.empty((2 * len(edit_bones), 3))
+        for j, eb in enumerate(edit_bones):
             b = armature.pose.bones[eb.name]
             if b.bony_original_saved:
                 # If stored original coordinates are found, just use them
@@ -396,23 +437,28 @@ class RepositionBones(bpy.types.Operator):
                 tail_co = b.bony_original_co_tail
             else:
                 # Store original coordinates
-                head_co = armature.matrix_world @ eb.head
-                if(eb.name == "ForearmBend_L"):
-                    print(head_co)
-                tail_co = armature.matrix_world @ eb.tail
+                head_co = m @ eb.head
+                tail_co = m @ eb.tail
                 b.bony_original_co_head = head_co
                 b.bony_original_co_tail = tail_co
                 b.bony_original_saved = True
 
-                bpy.context.view_layer.update()
+            coords[2 * j] = head_co
+            coords[2 * j + 1] = tail_co
+
+        # Query all the heads and tails at once, then move them in one batch
+        group_size = min(RepositionBones.N_CLOSEST_VER, len(raw_vertices))
+        idxs = np.empty((len(coords), group_size), dtype=np.int64)
+        dists = np.empty((len(coords), group_size), dtype=np.float32)
+        for i, co in enumerate(coords):
+            idxs[i], dists[i] = _unpack_nearest(kd.find_n(co, group_size))
 
-            new_head_co = calculate_new_co(head_co, RepositionBones.N_CLOSEST_VER,
-                                           evaluated_vertices, raw_vertices, kd)
-            new_tail_co = calculate_new_co(tail_co, RepositionBones.N_CLOSEST_VER,
-                                           evaluated_vertices, raw_vertices, kd)
+        new_coords = _accumulate_batch(coords, idxs, dists, delta)
 
-            eb.head = armature.matrix_world.inverted() @ new_head_co
-            eb.tail = armature.matrix_world.inverted() @ new_tail_co
+        new_coords = new_coords @ m_inv[:3, :3].T + m_inv[:3, 3]
+        for j, eb in enumerate(edit_bones):
+            eb.head = new_coords[2 * j]
+            eb.tail = new_coords[2 * j + 1]
 
 
         bpy.context.view_layer.update()
@@ -445,13 +491,11 @@ def transfer_rigging(source, target):
             if m.type == 'ARMATURE':
                 bpy.ops.object.modifier_remove(modifier=m.name)
         ar = target.modifiers.new("Armature", 'ARMATURE')
-        source_ars = [m for m in source.modifiers if m.type == 'ARMATURE']
-        if source_ars:
-            s = source_ars[0]
-            ar.object = s.object
+        source_ar = next((m for m in source.modifiers if m.type == 'ARMATURE'), None)
+        if source_ar:
+            ar.object = source_ar.object
         else:
             raise RuntimeError("Source has no armature!")
-        bpy.context.view_layer.update()
         bpy.ops.object.modifier_move_to_index(modifier=ar.name, index=0)
 
 
@@ -487,39 +531,72 @@ class TransferRigging(bpy.types.Operator):
 
 
 
-def get_driver_of_shape_key(shape_key):
-    key = shape_key.id_data
-    p = re.compile(r'key_blocks\["(.+)"\]')
-    fcurves = key.animation_data.drivers
-    for f in fcurves:
-        m = p.search(f.data_path)
-        if m and m[1] == shape_key.name:
-            return f.driver
-    return None
+def get_drivers_of_shape_keys(key: bpy.types.Key) -> Dict[str, bpy.types.Driver]:
+    drivers = {}
+    if key.animation_data:
+        for f in key.animation_data.drivers:
+            m = _KEY_BLOCK_RE.search(f.data_path)
+            if m:
+                drivers.setdefault(m[1], f.driver)
+    return drivers
+
 
+def has_only_single_property_recur(shape_key, driver_map, visited=None, cache=None, cycles=None):
+    def check():
+        driver = driver_map.get(shape_key.name)
+
+        if not driver:
+            return True
+
+        for v in driver.variables:
+            if v.type != 'SINGLE_PROP':
+                return False
 
-# Doesn't detect circular dependency. Might cause infinite loop
-def has_only_single_property_recur(shape_key):
-    driver = get_driver_of_shape_key(shape_key)
+            for t in v.targets:
+                data_path_head, _, _ = t.data_path.rpartition('.')
+                if data_path_head:
+                    try:
+                        data_target = t.id.path_resolve(data_path_head)
+                    except ValueError:
+                        data_target = None
+                    if isinstance(data_target, bpy.types.ShapeKey):
+                        if data_target.id_data == shape_key.id_data:
+                            target_map = driver_map
+                        else:
+                            target_map = get_drivers_of_shape_keys(data_target.id_data)
+                        ret = has_only_single_property_recur(data_target, target_map, visited, cache, cycles)
+                        if not ret:
+                            return False
 
-    if not driver:
         return True
 
-    for v in driver.variables:
-        if v.type != 'SINGLE_PROP':
-            return False
+    # visited: keys on the current recursion path
+    # cycles: keys of the path that were reached again, still waiting for their result
+    if visited is None:
+        visited = set()
+    if cache is None:
+        cache = {}
+    if cycles is None:
+        cycles = []
+
+    key = (shape_key.id_data.name, shape_key.name)
+    if key in cache:
+        return cache[key]
+    if key in visited:
+        # Circular dependency. Leave it to the key that started the cycle
+        cycles.append(key)
+        return True
+    visited.add(key)
+    n_cycles = len(cycles)
 
-        for t in v.targets:
-            data_path_head, _, _ = t.data_path.rpartition('.')
-            if data_path_head:
-                print(t.data_path)
-                data_target = eval("t.id." + data_path_head) # Hacky.
-                if isinstance(data_target, bpy.types.ShapeKey):
-                    ret = has_only_single_property_recur(data_target)
-                    if not ret:
-                        return False
+    ret = check()
 
-    return True
+    visited.discard(key)
+    cycles[n_cycles:] = [k for k in cycles[n_cycles:] if k != key]
+    # A True result that relied on an unfinished ancestor isn't final yet
+    if not ret or len(cycles) == n_cycles:
+        cache[key] = ret
+    return ret
 
 
 def apply_shape_key(obj):
@@ -534,10 +611,12 @@ def merge_non_corrective_shape_keys(obj):
     to_remove = []
     if hasattr(obj.data, "shape_keys"):
         obj.shape_key_add(name=MERGED_KEY_NAME, from_mix=True)
+        driver_map = get_drivers_of_shape_keys(obj.data.shape_keys)
+        cache = {}
         for shape_key in obj.data.shape_keys.key_blocks[1:]: # Skip Basis
             if shape_key.name == MERGED_KEY_NAME:
                 shape_key.value = 1
-            elif has_only_single_property_recur(shape_key):
+            elif has_only_single_property_recur(shape_key, driver_map, cache=cache):
                 to_remove.append(shape_key)
     
     for shape_key in to_remove:
@@ -562,18 +641,10 @@ class ApplyShapeKeys(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        selected = bpy.context.selected_objects
-
-        if len(selected) == 0:
-            return False
-        for obj in selected:
-            if obj.type != 'MESH':
-                return False
-
-        return True
+        return selected_one_or_more(context, 'MESH')
 
     def execute(self, context):
-        for_each_selected(context, apply_shape_key)
+        for_each_selected(context, apply_shape_key, set_active=False)
         return {'FINISHED'}
 
 
@@ -585,15 +656,7 @@ class MergeNonCorrectiveShapeKeys(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        selected = bpy.context.selected_objects
-
-        if len(selected) == 0:
-            return False
-        for obj in selected:
-            if obj.type != 'MESH':
-                return False
-
-        return True
+        return selected_one_or_more(context, 'MESH')
 
 
     def execute(self, context):
@@ -651,8 +714,7 @@ class InitializeClothing(bpy.types.Operator):
 
             bpy.ops.object.vertex_group_remove(all=True)
 
-            for i in range(len(obj.material_slots)):
-                bpy.ops.object.material_slot_remove({'object': obj})
+            obj.data.materials.clear()
             
             bpy.ops.object.origin_set(type='ORIGIN_GEOMETRY', center='BOUNDS')
 
@@ -812,13 +874,19 @@ CLASSES_TO_REGISTER = [
 
 
 def register():
-    [bpy.utils.register_class(klass) for klass in CLASSES_TO_REGISTER]
+    for klass in CLASSES_TO_REGISTER:
+        bpy.utils.register_class(klass)
     bpy.types.Scene.bony_settings = bpy.props.PointerProperty(type=BonySettings)
 
+    # Compile the jitted functions now instead of on the first Reposition Bones
+    _accumulate_batch(np.zeros((1, 3)), np.zeros((1, 1), dtype=np.int64), np.ones((1, 1), dtype=np.float32),
+                      np.zeros((1, 3), dtype=np.float32))
+
 
 def unregister():
     try:
-        [bpy.utils.unregister_class(klass) for klass in CLASSES_TO_REGISTER]
+        for klass in CLASSES_TO_REGISTER:
+            bpy.utils.unregister_class(klass)
         del bpy.types.Scene.bony_settings
     except RuntimeError:
         pass
\ No newline at end of file
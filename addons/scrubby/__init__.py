@@ -49,7 +49,7 @@ class PlayToEnd(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        return not bpy.context.screen.is_animation_playing
+        return not context.screen.is_animation_playing
 
 
     def execute(self, context):
@@ -79,7 +79,7 @@ class PlayToNextMarker(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        return not bpy.context.screen.is_animation_playing
+        return not context.screen.is_animation_playing
 
 
     def execute(self, context):
@@ -112,7 +112,7 @@ class PlayPingPong(bpy.types.Operator):
 
     @classmethod
     def poll(cls, context):
-        return not bpy.context.screen.is_animation_playing
+        return not context.screen.is_animation_playing
 
 
     def execute(self, context):
@@ -149,11 +149,13 @@ CLASSES_TO_REGISTER = [
 ]
 
 def register():
-    [bpy.utils.register_class(klass) for klass in CLASSES_TO_REGISTER]
+    for klass in CLASSES_TO_REGISTER:
+        bpy.utils.register_class(klass)
 
 
 def unregister():
     try:
-        [bpy.utils.unregister_class(klass) for klass in CLASSES_TO_REGISTER]
+        for klass in CLASSES_TO_REGISTER:
+            bpy.utils.unregister_class(klass)
     except RuntimeError:
         pass
\ No newline at end of file